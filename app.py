@@ -1,19 +1,26 @@
 # app.py
 import streamlit as st
-import fitz
 import json
+import orjson
 import google.generativeai as genai
 import os
-import re
+import string
+import hashlib
+import diskcache
+import numpy as np
+import tiktoken
 import streamlit.components.v1 as components
 from dotenv import load_dotenv
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from prompts import PIPELINE_PROMPT, prompt_parts
+from pdf_utils import extract_pdf_text
 
 # --- Load environment ---
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
+API_KEY_ERROR = "GEMINI_API_KEY not found. Set it in your Streamlit secrets or .env file."
 if not api_key:
-    st.error("GEMINI_API_KEY not found. Set it in your Streamlit secrets or .env file.")
+    st.error(API_KEY_ERROR)
 else:
     genai.configure(api_key=api_key)
 
@@ -25,57 +32,253 @@ SAFETY_SETTINGS = {
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
 }
 
-# --- PIPELINE_PROMPT ---
-PIPELINE_PROMPT = """
-You are a world-class AI research synthesizer. Your mission is to generate a deep analysis report with several intelligence components.
-
-**CRITICAL INSTRUCTIONS & OUTPUT FORMAT:**
-Return ONLY a single JSON object. Do not use markdown.
-
-1. Extract Core Information: identify key constructs and authors.
-2. Summarize & Assess Bias: summary + bias assessment.
-3. Analyze Causal Contradiction: central thesis, stances by paper, graph edges.
-4. Reference Intelligence: recommend one foundational cited paper.
-5. Multidisciplinary Connections: identify 2-3 other academic fields.
-
-**JSON OUTPUT FORMAT**:
-{{
-  "construct_analysis": {{
-    "shared": [],
-    "unique_by_paper": []
-  }},
-  "paper_summaries": [],
-  "causal_contradiction": {{
-    "central_thesis": "",
-    "stances": [],
-    "graph": {{
-      "nodes": [],
-      "edges": []
-    }}
-  }},
-  "reference_intelligence": {{
-    "recommendation_found": false,
-    "recommended_paper_title": "",
-    "justification": ""
-  }},
-  "multidisciplinary_connections": []
-}}
-
-**Papers to Analyze:**
----
-{text}
----
-"""
+# --- Gemini model ---
+MODEL_NAME = 'gemini-2.5-flash'
+
+WARMUP_TIMEOUT_SECONDS = 5
+
+# Created once per process and primed with a cheap count_tokens call so the
+# first report doesn't pay for channel/TLS setup. The timeout keeps an
+# unreachable endpoint from stalling the first render.
+@st.cache_resource
+def get_model():
+    model = genai.GenerativeModel(MODEL_NAME)
+    try:
+        model.count_tokens("warmup", request_options={"timeout": WARMUP_TIMEOUT_SECONDS})
+    except Exception:
+        pass
+    return model
+
+model = get_model() if api_key else None
+
+# --- Conflict graph template ---
+# Pinned vis-network version so the browser can serve it from HTTP cache.
+GRAPH_TEMPLATE = string.Template("""
+<div id="graph-container" style="width: 100%; height: 450px;"></div>
+<script type="text/javascript" src="https://unpkg.com/vis-network@9.1.9/standalone/umd/vis-network.min.js"></script>
+<script>
+    var nodes = new vis.DataSet($nodes);
+    var edges = new vis.DataSet($edges);
+    var container = document.getElementById('graph-container');
+    var data = { nodes: nodes, edges: edges };
+    var options = {
+        layout: { hierarchical: false },
+        nodes: { borderWidth: 2, font: { size: 16 } },
+        edges: { font: { align: 'middle', size: 14 }, arrows: 'to' },
+        physics: { solver: 'barnesHut', barnesHut: { gravitationalConstant: -30000, centralGravity: 0.1, springLength: 300 } },
+        interaction: { hover: true }
+    };
+    new vis.Network(container, data, options);
+</script>
+""")
+
+# Per-item fields vis-network uses for drawing ("title" is the hover tooltip,
+# "group" drives automatic per-group colouring); anything else Gemini adds is
+# dropped before inlining into the HTML.
+GRAPH_NODE_KEYS = ("id", "label", "title", "group", "color", "shape", "size", "value", "font", "level")
+GRAPH_EDGE_KEYS = ("id", "from", "to", "label", "title", "color", "dashes", "width", "value", "arrows", "font")
+
+def project_keys(items, keys):
+    return [{k: item[k] for k in keys if k in item} for item in items if isinstance(item, dict)]
+
+# --- Per-paper text limit ---
+# Papers are capped by tokens; pdf_utils.MAX_CHARS_PER_PAPER only bounds
+# how much text is extracted before token trimming.
+MAX_TOKENS_PER_PAPER = 2500
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+# tiktoken downloads its BPE file on first use; if that fails, None is cached
+# and trimming falls back to the character estimate for this process.
+@st.cache_resource
+def get_tokenizer():
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+def trim_to_token_budget(text, budget=MAX_TOKENS_PER_PAPER):
+    # Preflight on length so short papers never hit the tokenizer
+    if len(text) / CHARS_PER_TOKEN_ESTIMATE <= budget:
+        return text
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return text[:budget * CHARS_PER_TOKEN_ESTIMATE]
+    tokens = tokenizer.encode(text)
+    if len(tokens) <= budget:
+        return text
+    # Decode via bytes so a character split at the cut is dropped, not
+    # replaced with U+FFFD
+    return tokenizer.decode_bytes(tokens[:budget]).decode("utf-8", errors="ignore")
+
+# --- Near-duplicate detection ---
+# 64-bit SimHash over word 3-shingles; papers within this many differing
+# bits are treated as the same document.
+NEAR_DUPLICATE_DISTANCE = 3
+MIN_FINGERPRINT_WORDS = 20
+
+def simhash(text, shingle_size=3):
+    # Too little text (e.g. scanned, image-only PDFs) to fingerprint reliably
+    words = text.split()
+    if len(words) < max(shingle_size, MIN_FINGERPRINT_WORDS):
+        return None
+    weights = [0] * 64
+    for i in range(len(words) - shingle_size + 1):
+        shingle = " ".join(words[i:i + shingle_size])
+        h = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
 
 # --- JSON parsing helper ---
+JSON_DECODER = json.JSONDecoder()
+
 def clean_and_parse_json(response_text):
-    match = re.search(r'\{[\s\S]*\}', response_text)
-    if not match:
-        raise ValueError(f"No valid JSON found in response. RAW (first 500 chars):\n{response_text[:500]}")
-    return json.loads(match.group(0).strip())
+    start = response_text.find('{')
+    if start != -1:
+        # raw_decode stops at the end of the first object, ignoring trailing prose
+        try:
+            return JSON_DECODER.raw_decode(response_text, start)[0]
+        except json.JSONDecodeError:
+            pass
+        end = response_text.rfind('}')
+        if end > start:
+            try:
+                return orjson.loads(response_text[start:end + 1])
+            except orjson.JSONDecodeError:
+                pass
+    raise ValueError(f"No valid JSON found in response. RAW (first 500 chars):\n{response_text[:500]}")
+
+# --- Streaming JSON reader ---
+def read_json_stream(response):
+    # Track brace depth (ignoring braces inside strings) so we can stop
+    # consuming the stream as soon as the top-level object closes.
+    buffer = []
+    depth, started, in_string, escaped = 0, False, False, False
+    for chunk in response:
+        text = chunk.text
+        buffer.append(text)
+        for ch in text:
+            if not started:
+                if ch == '{':
+                    started, depth = True, 1
+            elif in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    return "".join(buffer)
+    return "".join(buffer)
+
+# --- Report cache ---
+# Exact tier: blake2b of the model, prompt version and combined text.
+# Semantic tier: one normalized embedding per paper; a stored report is only
+# reused for the same model, prompt and filenames when every paper matches.
+# Embeddings live in a single index entry, {context: (keys, vectors)} with
+# vectors shaped (N, papers, dim), so lookups never load stored reports.
+REPORT_CACHE_DIR = os.path.join(".cache", "reports")
+SEMANTIC_INDEX_KEY = "semantic-index"
+SIMILARITY_THRESHOLD = 0.95
+EMBEDDING_CHARS_PER_PAPER = 8000
+PROMPT_VERSION = hashlib.blake2b(PIPELINE_PROMPT.encode(), digest_size=8).hexdigest()
+
+@st.cache_resource
+def get_report_cache():
+    return diskcache.Cache(REPORT_CACHE_DIR)
+
+def embed_papers(paper_texts):
+    result = genai.embed_content(
+        model="models/text-embedding-004",
+        content=[text[:EMBEDDING_CHARS_PER_PAPER] for text in paper_texts],
+    )
+    vectors = np.asarray(result["embedding"], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def find_similar_report(context, embeddings):
+    report_cache = get_report_cache()
+    keys, vectors = report_cache.get(SEMANTIC_INDEX_KEY, {}).get(context, ([], None))
+    if not keys:
+        return None
+    # Cosine similarity per paper for every stored report; the least similar
+    # paper decides
+    scores = np.einsum("npd,pd->np", vectors, embeddings).min(axis=1)
+    best = int(np.argmax(scores))
+    if scores[best] <= SIMILARITY_THRESHOLD:
+        return None
+    cached = report_cache.get(keys[best])
+    return cached["report"] if cached is not None else None
+
+def store_report(key, context, embeddings, parsed_data):
+    report_cache = get_report_cache()
+    with report_cache.transact():
+        report_cache[key] = {"report": parsed_data}
+        if embeddings is None:
+            return
+        index = report_cache.get(SEMANTIC_INDEX_KEY, {})
+        keys, vectors = index.get(context, ([], None))
+        if vectors is None:
+            vectors = embeddings[np.newaxis]
+        else:
+            vectors = np.concatenate((vectors, embeddings[np.newaxis]))
+        index[context] = (keys + [key], vectors)
+        report_cache[SEMANTIC_INDEX_KEY] = index
+
+def get_report(combined_text, papers, show_raw=False):
+    report_cache = get_report_cache()
+    key = hashlib.blake2b(f"{MODEL_NAME}\0{PROMPT_VERSION}\0{combined_text}".encode()).hexdigest()
+    cached = report_cache.get(key)
+    if cached is not None:
+        return cached["report"]
+
+    # Sort by filename so the same set of papers lines up row for row
+    papers = sorted(papers, key=lambda paper: paper[0])
+    context = (MODEL_NAME, PROMPT_VERSION, tuple(name for name, _ in papers))
+    # The semantic tier is best effort; an embedding failure only skips it
+    try:
+        embeddings = embed_papers([text for _, text in papers])
+    except Exception:
+        embeddings = None
+    if embeddings is not None:
+        parsed_data = find_similar_report(context, embeddings)
+        if parsed_data is not None:
+            # Semantic hits are not stored under this exact key
+            return parsed_data
+
+    # --- Format prompt ---
+    prefix, suffix = prompt_parts()
+    prompt = "".join((prefix, combined_text, suffix))
+
+    # --- Call Gemini ---
+    response = model.generate_content(
+        prompt,
+        stream=True,
+        safety_settings=SAFETY_SETTINGS
+    )
+
+    raw_text = read_json_stream(response)
+    if show_raw:
+        st.code(raw_text[:1000])
+
+    # --- Parse JSON safely ---
+    parsed_data = clean_and_parse_json(raw_text)
+
+    store_report(key, context, embeddings, parsed_data)
+    return parsed_data
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="RationelMind AI", layout="wide")
+DEBUG = st.sidebar.checkbox("Show raw Gemini response", value=False)
 st.title("RationelMind AI - Research Intelligence")
 st.write("Upload 2–3 PDFs to generate a deep intelligence report.")
 
@@ -86,101 +289,125 @@ uploaded_files = st.file_uploader(
 )
 
 if st.button("Generate Intelligence Report"):
-    if not uploaded_files or len(uploaded_files) < 2:
+    if model is None:
+        st.error(API_KEY_ERROR)
+    elif not uploaded_files or len(uploaded_files) < 2:
         st.error("Please upload at least 2 PDFs.")
     else:
         with st.spinner("Analyzing papers..."):
             try:
-                # --- Combine PDF texts ---
-                combined_text = ""
+                # --- Skip byte-identical uploads ---
+                files, buffers, seen = [], [], {}
                 for file in uploaded_files:
-                    doc = fitz.open(stream=file.read(), filetype="pdf")
-                    paper_text = "".join(page.get_text() for page in doc)[:8000]  # limit per paper
-                    combined_text += f"--- Paper: {file.name} ---\n{paper_text}\n\n"
-                    doc.close()
-
-                # --- Format prompt ---
-                prompt = PIPELINE_PROMPT.format(text=combined_text)
-
-                # --- Call Gemini ---
-                model = genai.GenerativeModel('gemini-2.5-flash')
-                response = model.generate_content(
-                    prompt,
-                    stream=False,
-                    safety_settings=SAFETY_SETTINGS
-                )
+                    buf = file.getvalue()
+                    digest = hashlib.blake2b(buf, digest_size=16).digest()
+                    if digest in seen:
+                        st.warning(f"Skipped {file.name}: identical to {seen[digest]}")
+                        continue
+                    seen[digest] = file.name
+                    files.append(file)
+                    buffers.append(buf)
+
+                # PyMuPDF is not thread-safe, so papers are extracted one at a time
+                paper_texts = [extract_pdf_text(buf) for buf in buffers]
+                paper_texts = [trim_to_token_budget(text) for text in paper_texts]
+
+                # --- Skip near-duplicate texts ---
+                papers, fingerprints = [], []
+                for file, paper_text in zip(files, paper_texts):
+                    fingerprint = simhash(paper_text)
+                    if fingerprint is not None:
+                        match = next((name for name, other in fingerprints
+                                      if hamming_distance(fingerprint, other) <= NEAR_DUPLICATE_DISTANCE), None)
+                        if match is not None:
+                            st.warning(f"Skipped {file.name}: near-duplicate of {match}")
+                            continue
+                        fingerprints.append((file.name, fingerprint))
+                    papers.append((file, paper_text))
+                if len(papers) < 2:
+                    raise ValueError("Please upload at least 2 distinct PDFs.")
 
-                # --- Parse JSON safely ---
-                parsed_data = clean_and_parse_json(response.text)
+                # --- Combine PDF texts ---
+                parts = []
+                for file, paper_text in papers:
+                    parts.append(f"--- Paper: {file.name} ---\n")
+                    parts.append(paper_text)
+                    parts.append("\n\n")
+                combined_text = "".join(parts)
+
+                # --- Generate (or reuse cached) report ---
+                parsed_data = get_report(
+                    combined_text,
+                    [(file.name, paper_text) for file, paper_text in papers],
+                    show_raw=DEBUG,
+                )
 
                 st.success("✅ Analysis complete!")
 
+                # Each section is emitted as one Markdown blob to keep the
+                # number of Streamlit elements (and websocket messages) low.
+                # Blocks are separated by blank lines so bold labels don't
+                # merge into the preceding list.
+
                 # --- Render Shared Constructs ---
-                st.header("1. Shared Constructs")
-                for c in parsed_data.get('construct_analysis', {}).get('shared', []):
-                    st.markdown(f"- {c}")
+                lines = ["## 1. Shared Constructs"]
+                lines += [f"- {c}" for c in parsed_data.get('construct_analysis', {}).get('shared', [])]
+                st.markdown("\n".join(lines))
 
                 # --- Render Unique Constructs ---
-                st.header("2. Unique Constructs by Paper")
+                blocks = ["## 2. Unique Constructs by Paper"]
                 for item in parsed_data.get('construct_analysis', {}).get('unique_by_paper', []):
                     filename = item.get("filename") or item.get("paper") or "Unknown Paper"
                     constructs = item.get("unique") or item.get("constructs", [])
-                    st.markdown(f"**{filename}**")
-                    for u in constructs:
-                        st.markdown(f"- {u}")
+                    lines = [f"**{filename}**"]
+                    lines += [f"- {u}" for u in constructs]
+                    blocks.append("\n".join(lines))
+                st.markdown("\n\n".join(blocks))
 
                 # --- Render Summaries & Bias ---
-                st.header("3. Paper Summaries & Bias Assessment")
+                blocks = ["## 3. Paper Summaries & Bias Assessment"]
                 for paper in parsed_data.get('paper_summaries', []):
                     filename = paper.get("filename") or paper.get("paper") or "Unknown Paper"
-                    st.markdown(f"**{filename} ({paper.get('authors','Unknown')})**")
-                    st.markdown(f"- Summary: {paper.get('summary','No summary provided')}")
                     bias = paper.get('bias_assessment', {})
-                    st.markdown(f"- Bias: {bias.get('level','Unknown')} ({bias.get('justification','No justification')})")
+                    blocks.append("\n".join([
+                        f"**{filename} ({paper.get('authors','Unknown')})**",
+                        f"- Summary: {paper.get('summary','No summary provided')}",
+                        f"- Bias: {bias.get('level','Unknown')} ({bias.get('justification','No justification')})",
+                    ]))
+                st.markdown("\n\n".join(blocks))
 
                 # --- Render Causal Contradiction ---
-                st.header("4. Causal Contradiction / Stances")
                 thesis = parsed_data.get('causal_contradiction', {}).get('central_thesis', 'Not provided')
-                st.markdown(f"**Central Thesis:** {thesis}")
+                lines = []
                 for stance in parsed_data.get('causal_contradiction', {}).get('stances', []):
                     filename = stance.get("filename") or stance.get("paper") or "Unknown Paper"
-                    st.markdown(f"- {filename} ({stance.get('authors','Unknown')}): {stance.get('stance','No stance')}")
+                    lines.append(f"- {filename} ({stance.get('authors','Unknown')}): {stance.get('stance','No stance')}")
+                blocks = ["## 4. Causal Contradiction / Stances", f"**Central Thesis:** {thesis}", "\n".join(lines)]
+                st.markdown("\n\n".join(blocks))
 
                 # --- Render Visual Graph ---
                 st.header("5. Visual Conflict Graph")
-                graph_html = f"""
-                <div id="graph-container" style="width: 100%; height: 450px;"></div>
-                <script type="text/javascript" src="https://unpkg.com/vis-network/standalone/umd/vis-network.min.js"></script>
-                <script>
-                    var nodes = new vis.DataSet({json.dumps(parsed_data.get('causal_contradiction', {}).get('graph', {}).get('nodes', []))});
-                    var edges = new vis.DataSet({json.dumps(parsed_data.get('causal_contradiction', {}).get('graph', {}).get('edges', []))});
-                    var container = document.getElementById('graph-container');
-                    var data = {{ nodes: nodes, edges: edges }};
-                    var options = {{
-                        layout: {{ hierarchical: false }},
-                        nodes: {{ borderWidth: 2, font: {{ size: 16 }} }},
-                        edges: {{ font: {{ align: 'middle', size: 14 }}, arrows: 'to' }},
-                        physics: {{ solver: 'barnesHut', barnesHut: {{ gravitationalConstant: -30000, centralGravity: 0.1, springLength: 300 }} }},
-                        interaction: {{ hover: true }}
-                    }};
-                    new vis.Network(container, data, options);
-                </script>
-                """
+                graph = parsed_data.get('causal_contradiction', {}).get('graph', {})
+                nodes_js = orjson.dumps(project_keys(graph.get('nodes', []), GRAPH_NODE_KEYS)).decode()
+                edges_js = orjson.dumps(project_keys(graph.get('edges', []), GRAPH_EDGE_KEYS)).decode()
+                graph_html = GRAPH_TEMPLATE.substitute(nodes=nodes_js, edges=edges_js)
                 components.html(graph_html, height=500, scrolling=True)
 
                 # --- Render Reference Intelligence ---
-                st.header("6. Reference Intelligence")
+                blocks = ["## 6. Reference Intelligence"]
                 ref = parsed_data.get('reference_intelligence', {})
                 if ref.get('recommendation_found', False):
-                    st.markdown(f"**Recommended Paper:** {ref.get('recommended_paper_title','')}")
-                    st.markdown(f"{ref.get('justification','')}")
+                    blocks.append(f"**Recommended Paper:** {ref.get('recommended_paper_title','')}")
+                    blocks.append(f"{ref.get('justification','')}")
                 else:
-                    st.markdown("No specific paper could be recommended from the references.")
+                    blocks.append("No specific paper could be recommended from the references.")
+                st.markdown("\n\n".join(blocks))
 
                 # --- Render Multidisciplinary Connections ---
-                st.header("7. Multidisciplinary Connections")
+                lines = ["## 7. Multidisciplinary Connections"]
                 for c in parsed_data.get('multidisciplinary_connections', []):
-                    st.markdown(f"- **{c.get('field','Unknown')}**: {c.get('connection','No connection provided')}")
+                    lines.append(f"- **{c.get('field','Unknown')}**: {c.get('connection','No connection provided')}")
+                st.markdown("\n".join(lines))
 
             except Exception as e:
                 st.error(f"❌ Analysis Failed: {e}")
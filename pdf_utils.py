@@ -0,0 +1,25 @@
+# pdf_utils.py
+import streamlit as st
+import fitz
+
+# Upper bound on characters pulled from each paper before token trimming
+MAX_CHARS_PER_PAPER = 16000
+
+# --- PDF extraction helper ---
+# Cached on the PDF bytes, so unchanged uploads skip fitz on rerun
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_pdf_text(pdf_bytes: bytes, cap: int = MAX_CHARS_PER_PAPER) -> str:
+    # Stop reading pages once the cap is reached
+    parts, total = [], 0
+    # memoryview lets fitz read the buffer without another bytes copy
+    doc = fitz.open(stream=memoryview(pdf_bytes), filetype="pdf")
+    for page in doc:
+        # Unsorted blocks skip line reordering; block type 0 is text, 1 is image
+        blocks = page.get_text("blocks", sort=False)
+        page_text = "\n".join(b[4] for b in blocks if b[6] == 0)
+        parts.append(page_text)
+        total += len(page_text)
+        if total >= cap:
+            break
+    doc.close()
+    return "".join(parts)[:cap]
@@ -0,0 +1,55 @@
+# prompts.py
+import functools
+
+# --- PIPELINE_PROMPT ---
+PIPELINE_PROMPT = """
+You are a world-class AI research synthesizer. Your mission is to generate a deep analysis report with several intelligence components.
+
+**CRITICAL INSTRUCTIONS & OUTPUT FORMAT:**
+Return ONLY a single JSON object. Do not use markdown.
+
+1. Extract Core Information: identify key constructs and authors.
+2. Summarize & Assess Bias: summary + bias assessment.
+3. Analyze Causal Contradiction: central thesis, stances by paper, graph edges.
+4. Reference Intelligence: recommend one foundational cited paper.
+5. Multidisciplinary Connections: identify 2-3 other academic fields.
+
+**JSON OUTPUT FORMAT**:
+{{
+  "construct_analysis": {{
+    "shared": [],
+    "unique_by_paper": []
+  }},
+  "paper_summaries": [],
+  "causal_contradiction": {{
+    "central_thesis": "",
+    "stances": [],
+    "graph": {{
+      "nodes": [],
+      "edges": []
+    }}
+  }},
+  "reference_intelligence": {{
+    "recommendation_found": false,
+    "recommended_paper_title": "",
+    "justification": ""
+  }},
+  "multidisciplinary_connections": []
+}}
+
+**Papers to Analyze:**
+---
+{text}
+---
+"""
+
+# Static prefix/suffix around the paper text, split once per process.
+# Keeping the prefix first and unchanged lets Gemini's implicit context
+# cache reuse it across requests.
+@functools.lru_cache(maxsize=1)
+def prompt_parts():
+    prefix, suffix = PIPELINE_PROMPT.split("{text}", 1)
+    return (
+        prefix.replace("{{", "{").replace("}}", "}"),
+        suffix.replace("{{", "{").replace("}}", "}"),
+    )